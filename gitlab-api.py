@@ -3,13 +3,17 @@ from enum import Enum, auto
 import requests
 import urllib.parse
 import time
-from io import BytesIO
+import threading
+import email.utils
+import contextlib
+import hashlib
 import tempfile
 import subprocess
 import importlib
 modify_gitrepo = importlib.import_module("modify-gitrepo")
 import os
 import shutil
+from concurrent.futures import ThreadPoolExecutor
 
 # ---------------------------------------------------------------------------
 TLS_VERIFY=False
@@ -22,6 +26,245 @@ SRC_TOKEN = os.environ['SRC_TOKEN']
 DST_GITLAB_URL = os.environ['DST_GITLAB_URL']
 DST_TOKEN = os.environ['DST_TOKEN']
 GIT_BINARY = os.environ['GIT_BINARY']
+# Ceilings of concurrent project exports on source and project imports on dest
+MAX_EXPORTS = 8
+MAX_IMPORTS = 8
+# Project exports are kept on disk, so workers are sized by the request budgets rather than memory
+MAX_WORKERS = int(os.environ.get('MAX_WORKERS', MAX_EXPORTS + MAX_IMPORTS))
+CACHE_DIR = os.environ.get('CACHE_DIR', os.path.expanduser('~/.cache/modify-gitrepo'))
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', 10 * 1024 ** 3))
+
+# ---------------------------------------------------------------------------
+# LOGGING
+# ---------------------------------------------------------------------------
+
+# Projects are migrated in parallel, so log lines are prefixed with the project of the current thread
+LOG_CONTEXT = threading.local()
+
+def log(*args):
+  prefix = getattr(LOG_CONTEXT, 'prefix', '')
+  print(prefix + ' '.join(str(arg) for arg in args))
+
+
+@contextlib.contextmanager
+def log_prefix(prefix):
+  '''
+  Prefixes log lines of the current thread within the context.
+  '''
+  previous_prefix = getattr(LOG_CONTEXT, 'prefix', '')
+  LOG_CONTEXT.prefix = prefix
+  try:
+    yield
+  finally:
+    LOG_CONTEXT.prefix = previous_prefix
+
+
+# ---------------------------------------------------------------------------
+# REQUEST SCHEDULING
+# ---------------------------------------------------------------------------
+
+# Retries for throttled (429) requests, and for idempotent requests failing with 5xx
+MAX_RETRIES = 8
+# A response slower than this multiple of the average latency counts as a latency spike
+LATENCY_SPIKE_FACTOR = 3
+# Statuses that indicate the instance is overloaded
+THROTTLED_STATUSES = (429, 502, 503, 504)
+
+
+class RequestBudget:
+  '''
+  Concurrency budget for one class of endpoints on a Gitlab instance.
+
+  The number of requests in flight is adjusted with additive increase / multiplicative decrease:
+  the limit grows by about 1 per round of successful requests, and halves on throttling or latency spikes.
+  Latency is averaged per endpoint, as a listing is expected to be slower than a single lookup.
+  '''
+
+  def __init__(self, name, initial_limit, max_limit):
+    self.name = name
+    self.limit = float(min(initial_limit, max_limit))
+    self.max_limit = max_limit
+    self.in_flight = 0
+    self.sent = 0
+    self.decreased_at = 0
+    self.average_latency = {}
+    self.condition = threading.Condition()
+
+  def acquire(self):
+    '''
+    Waits until the request fits in the limit.
+
+    returns: ticket of the request, to pass to release
+    '''
+    with self.condition:
+      while self.in_flight >= int(self.limit):
+        self.condition.wait()
+      self.in_flight += 1
+      self.sent += 1
+      return self.sent
+
+  def release(self, ticket, endpoint, latency, throttled):
+    '''
+    ticket: ticket from acquire
+    endpoint: key from RequestScheduler.endpoint_key, or None to skip latency spike detection
+    latency: seconds until the response headers were received
+    throttled: whether the instance reported being overloaded
+    '''
+    with self.condition:
+      self.in_flight -= 1
+
+      average_latency = self.average_latency.get(endpoint)
+      spike = endpoint != None and average_latency != None and latency > LATENCY_SPIKE_FACTOR * average_latency
+      if throttled or spike:
+        # Requests sent before the last decrease react to the same overload, so they do not decrease again
+        if ticket > self.decreased_at:
+          self.limit = max(1.0, self.limit / 2)
+          self.decreased_at = self.sent
+      else:
+        self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+
+      # Throttled responses return early, so they would drag the average down
+      if endpoint != None and not throttled:
+        if average_latency == None:
+          self.average_latency[endpoint] = latency
+        else:
+          self.average_latency[endpoint] = 0.8 * average_latency + 0.2 * latency
+
+      self.condition.notify_all()
+
+
+class RequestScheduler:
+  '''
+  Sends requests to a Gitlab instance within per-endpoint concurrency budgets,
+  honoring the rate limit headers: https://docs.gitlab.com/ee/user/admin_area/settings/user_and_ip_rate_limits.html#response-headers
+
+  - RateLimit-Remaining / RateLimit-Reset: when no requests remain, all requests wait until the reset time.
+  - Retry-After: throttled requests wait for the advertised time before being retried.
+  '''
+
+  def __init__(self, name, budgets):
+    self.name = name
+    self.budgets = { budget.name: budget for budget in budgets }
+    self.paused_until = 0
+    self.lock = threading.Lock()
+
+  def request(self, method, budget_name, output_file = None, **kwargs):
+    '''
+    Sends a request with the requests library and returns the response.
+    Throttled requests, and idempotent requests failing with 5xx, are retried up to MAX_RETRIES times.
+
+    method: HTTP method
+    budget_name: budget the endpoint counts against: export, import or metadata.
+    output_file: [optional] path to stream a successful response body to, instead of keeping it in memory.
+    kwargs: arguments passed to requests.request
+    '''
+    budget = self.budgets[budget_name]
+    endpoint = self.endpoint_key(method, kwargs)
+    attempt = 0
+    while True:
+      self.wait_for_rate_limit()
+
+      # Uploaded files are read again on retries
+      for file in kwargs.get('files', {}).values():
+        if hasattr(file[1], 'seek'):
+          file[1].seek(0)
+
+      ticket = budget.acquire()
+      try:
+        response = requests.request(method, stream = output_file != None, **kwargs)
+        if output_file != None and response.ok:
+          with open(output_file, 'wb') as file:
+            for chunk in response.iter_content(chunk_size = 1024 * 1024):
+              file.write(chunk)
+      except Exception as e:
+        budget.release(ticket, None, 0, throttled = isinstance(e, requests.exceptions.RequestException))
+        raise
+      budget.release(ticket, endpoint, response.elapsed.total_seconds(), throttled = response.status_code in THROTTLED_STATUSES)
+
+      self.update_rate_limit(response)
+
+      retryable = response.status_code == 429 or (response.status_code >= 500 and method.lower() == 'get')
+      if not retryable or attempt >= MAX_RETRIES:
+        return response
+
+      delay = self.retry_delay(response, attempt)
+      log(f'  - {self.name} {budget_name} request returned {response.status_code}, retrying in {delay:.0f}s (limit={budget.limit:.1f}).')
+      time.sleep(delay)
+      attempt += 1
+
+  @staticmethod
+  def endpoint_key(method, kwargs):
+    '''
+    Returns the endpoint of a request for latency tracking, eg. "get /api/v4/projects/:id?statistics".
+    Returns None for uploads and downloads, whose latency depends on the size of the archive.
+
+    method: HTTP method
+    kwargs: arguments passed to requests.request
+    '''
+    path = urllib.parse.urlparse(kwargs['url']).path
+    if 'files' in kwargs or path.endswith('/export/download'):
+      return None
+
+    # Replace the id or url-encoded path of projects and groups
+    segments = path.split('/')
+    for i in range(1, len(segments)):
+      if segments[i - 1] in ('projects', 'groups'):
+        segments[i] = ':id'
+
+    params = sorted(key for key in kwargs.get('params', {}) if key not in ('page', 'per_page'))
+    return f'{method.lower()} {"/".join(segments)}?{"&".join(params)}'
+
+  def wait_for_rate_limit(self):
+    with self.lock:
+      delay = self.paused_until - time.time()
+    if delay > 0:
+      time.sleep(delay)
+
+  def update_rate_limit(self, response):
+    '''
+    Pauses all requests until RateLimit-Reset if RateLimit-Remaining is exhausted.
+    '''
+    remaining = response.headers.get('RateLimit-Remaining')
+    reset = response.headers.get('RateLimit-Reset')
+    if remaining == None or reset == None:
+      return
+
+    if int(remaining) <= 0:
+      with self.lock:
+        self.paused_until = max(self.paused_until, float(reset))
+      log(f'  - {self.name} rate limit exhausted, pausing until {time.ctime(float(reset))}.')
+
+  def retry_delay(self, response, attempt):
+    '''
+    Returns the seconds to wait before retrying, from Retry-After if present,
+    otherwise exponential backoff.
+    '''
+    retry_after = response.headers.get('Retry-After')
+    if retry_after == None:
+      return min(60, 2 ** attempt)
+
+    if retry_after.isdigit():
+      delay = float(retry_after)
+    else:
+      delay = email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time()
+    delay = max(0, delay)
+
+    # Throttling applies to the whole instance, not only this request
+    with self.lock:
+      self.paused_until = max(self.paused_until, time.time() + delay)
+    return delay
+
+
+# Each worker has at most one request in flight, plus the main thread, so higher limits are unreachable
+SRC_SCHEDULER = RequestScheduler('Source', [
+  RequestBudget('export', initial_limit = 2, max_limit = min(MAX_EXPORTS, MAX_WORKERS)),
+  RequestBudget('metadata', initial_limit = 4, max_limit = MAX_WORKERS + 1),
+])
+DST_SCHEDULER = RequestScheduler('Dest', [
+  RequestBudget('import', initial_limit = 2, max_limit = min(MAX_IMPORTS, MAX_WORKERS)),
+  RequestBudget('metadata', initial_limit = 4, max_limit = MAX_WORKERS + 1),
+])
+
 
 # ---------------------------------------------------------------------------
 class Action(Enum):
@@ -38,43 +281,67 @@ def migrate_group(source, dest_path = None, dest_name = None, projects = False):
   dest_path: [optional] dest full path. Autodetected if not provided.
   dest_name: [optional] dest name. Autodetected if not provided.
   projects: [optional] migrate projects within group. Default is False.
+  returns: list of migrated projects as returned by migrate_project.
+           Failed projects are included as (source, None, None, error).
   '''
-  # Export
-  (detected_source_group_path, detected_source_group_name, group_data) = export_group(source)
-  print()
-  
-  # Determine import location
-  if dest_path != None:
-    print(f'Importing group to specified path at: {dest_path}')
-  else:
-    dest_path = detected_source_group_path
-    print(f'Importing group to detected path at: {dest_path}')
+  migrated_projects = []
+  with ThreadPoolExecutor(max_workers = MAX_WORKERS + 1) as executor:
+    # Export and import the group while project exports run alongside it.
+    # The group task is submitted first so it always gets a worker.
+    group_future = executor.submit(export_import_group, source, dest_path, dest_name)
+
+    if projects:
+      project_ids = get_projects_in_group(source)
+      project_futures = [
+        executor.submit(migrate_project, project_id, namespace_ready = group_future)
+        for project_id in project_ids
+      ]
+      for (project_id, project_future) in zip(project_ids, project_futures):
+        try:
+          migrated_projects.append(project_future.result())
+        except Exception as e:
+          log(f'Migration of project {project_id} failed: {e}')
+          migrated_projects.append((project_id, None, None, str(e)))
+
+    group_future.result()
+
+  return migrated_projects
+
+
+def export_import_group(source, dest_path = None, dest_name = None):
+  '''
+  Exports a Gitlab group from source and imports it to dest.
+  Subgroups are included in the group export.
 
-  if dest_name != None:
-    print(f'Importing group with specified name: {dest_name}')
-  else:
-    dest_name = detected_source_group_name
-    print(f'Importing group with detected name: {dest_name}')
-  
-  print()
+  source: source group in format group_id or namespace (full path).
+  dest_path: [optional] dest full path. Autodetected if not provided.
+  dest_name: [optional] dest name. Autodetected if not provided.
+  '''
+  with log_prefix(f'[group {source}] '):
+    # Export
+    (detected_source_group_path, detected_source_group_name, group_data) = export_group(source)
 
-  # Debugging -> save exported file to disk
-  # open('file.tar.gz', 'wb').write(group_data)
+    # Determine import location
+    if dest_path != None:
+      log(f'Importing group to specified path at: {dest_path}')
+    else:
+      dest_path = detected_source_group_path
+      log(f'Importing group to detected path at: {dest_path}')
 
-  # Import Group
-  import_group(dest_path, dest_name, group_data)
-  print()
+    if dest_name != None:
+      log(f'Importing group with specified name: {dest_name}')
+    else:
+      dest_name = detected_source_group_name
+      log(f'Importing group with detected name: {dest_name}')
 
-  # Import Projects
-  if projects:
-    project_ids = get_projects_in_group(source)
-    for project_id in project_ids:
-      print('---------------------------------------------------------------------------')
-      migrate_project(project_id)
+    # Debugging -> save exported file to disk
+    # open('file.tar.gz', 'wb').write(group_data)
 
+    # Import Group
+    import_group(dest_path, dest_name, group_data)
 
 
-def migrate_project(source, dest_path = None, dest_name = None):
+def migrate_project(source, dest_path = None, dest_name = None, namespace_ready = None):
   '''
   Migrates a Gitlab project from source to dest.
   If dest is not provided, it will be derived from source.
@@ -82,42 +349,50 @@ def migrate_project(source, dest_path = None, dest_name = None):
   source: source project in format project_id or namespace/project (full path).
   dest_path: [optional] dest full path. Autodetected if not provided.
   dest_name: [optional] dest name. Autodetected if not provided.
+  namespace_ready: [optional] future of the group import creating the dest namespace.
+                   Export and modification run immediately, import waits for it.
+  returns: (source, dest_path, bundle_heads, None) for verify_projects
   '''
+  with log_prefix(f'[project {source}] '), tempfile.TemporaryDirectory() as tmpdirname:
+    log('---------------------------------------------------------------------------')
+    project_file = f'{tmpdirname}/file.tar.gz'
 
-  # Export
-  (detected_source_project_path, detected_source_project_name, project_data) = export_project(source)
-  print()
+    # Export
+    (detected_source_project_path, detected_source_project_name) = export_project(source, project_file)
 
-  # Determine import location
-  if dest_path != None:
-    print(f'Importing project to specified path at: {dest_path}')
-  else:
-    dest_path = detected_source_project_path
-    print(f'Importing project to detected path at: {dest_path}')
+    # Determine import location
+    if dest_path != None:
+      log(f'Importing project to specified path at: {dest_path}')
+    else:
+      dest_path = detected_source_project_path
+      log(f'Importing project to detected path at: {dest_path}')
 
-  if dest_name != None:
-    print(f'Importing project with specified name: {dest_name}')
-  else:
-    dest_name = detected_source_project_name
-    print(f'Importing project with detected name: {dest_name}')
+    if dest_name != None:
+      log(f'Importing project with specified name: {dest_name}')
+    else:
+      dest_name = detected_source_project_name
+      log(f'Importing project with detected name: {dest_name}')
 
-  print()
+    # Debugging -> save exported file to disk
+    # shutil.copyfile(project_file, 'file.tar.gz')
 
-  # Debugging -> save exported file to disk
-  # open('file.tar.gz', 'wb').write(project_data)
+    # modify repo
+    bundle_heads = modify_repo(project_file)
 
-  # modify repo
-  modified_project_data = modify_repo(project_data)
-  print()
+    # Debugging -> save modified exported file to disk
+    # shutil.copyfile(project_file, 'file.tar.gz')
 
-  # Debugging -> save modified exported file to disk
-  # open('file.tar.gz', 'wb').write(modified_project_data)
+    # Wait for the dest namespace to be created by the group import
+    if namespace_ready != None:
+      namespace_ready.result()
+      wait_for_namespace(dest_path.rsplit("/", 1)[0])
 
-  import_project(dest_path, dest_name, modified_project_data)
-  print()
+    import_project(dest_path, dest_name, project_file)
+
+    migrate_ci_variables(source, dest_path)
+
+    return (source, dest_path, bundle_heads, None)
 
-  migrate_ci_variables(source, dest_path)
-  
 
 # ---------------------------------------------------------------------------
 
@@ -128,7 +403,7 @@ def get_projects_in_group(source):
   source: source group in format project_id or namespace (full path).
   returns: list of project ids
   '''  
-  print(f'Listing projects from: {source}.')
+  log(f'Listing projects from: {source}.')
   source_url_safe = urllib.parse.quote_plus(source)
 
   project_list = []
@@ -145,7 +420,7 @@ def get_projects_in_group(source):
       "per_page": 100,
       "include_subgroups": True,
     }
-    response = requests.get(
+    response = SRC_SCHEDULER.request('get', 'metadata',
       url = f'{SRC_GITLAB_URL}/api/v4/groups/{source_url_safe}/projects',
       headers = headers,
       params = params,
@@ -165,12 +440,12 @@ def get_projects_in_group(source):
     if int(current_page) >= int(total_pages):
       more_pages = False
       if len(project_list) != int(total_projects):
-        print(f'- Detected project count {len(project_list)} != advertised project count {total_projects}.')
+        log(f'- Detected project count {len(project_list)} != advertised project count {total_projects}.')
         sys.exit(1)
       else:
-        print(f'- {total_projects} projects detected: {project_list}')
+        log(f'- {total_projects} projects detected: {project_list}')
     else:
-      print(f'- Processing page {current_page} of {total_pages}')
+      log(f'- Processing page {current_page} of {total_pages}')
       current_page = current_page + 1
 
   return project_list
@@ -184,14 +459,14 @@ def export_group(source):
   source: source group in format project_id or namespace (full path).
   returns: (detected_source_group_path, detected_source_group_name, group_data)
   '''
-  print(f'Exporting group from: {source}.')
+  log(f'Exporting group from: {source}.')
   source_url_safe = urllib.parse.quote_plus(source)
 
   # Detect the source group namespace
   headers = {
     'PRIVATE-TOKEN': f'{SRC_TOKEN}'
   }
-  response = requests.get(
+  response = SRC_SCHEDULER.request('get', 'metadata',
     url = f'{SRC_GITLAB_URL}/api/v4/groups/{source_url_safe}',
     headers = headers,
     verify = TLS_VERIFY,
@@ -200,11 +475,11 @@ def export_group(source):
   response.raise_for_status()
   detected_source_group_path = response.json()['full_path']
   detected_source_group_name = response.json()['name']
-  print(f'- Detected path is: {detected_source_group_path}, detected name is: {detected_source_group_name}.')
+  log(f'- Detected path is: {detected_source_group_path}, detected name is: {detected_source_group_name}.')
 
   # Initiate export
-  print(f'- Initiating export for group {source}...')
-  response = requests.post(
+  log(f'- Initiating export for group {source}...')
+  response = SRC_SCHEDULER.request('post', 'export',
     url = f'{SRC_GITLAB_URL}/api/v4/groups/{source_url_safe}/export',
     headers = headers,
     verify = TLS_VERIFY,
@@ -213,11 +488,11 @@ def export_group(source):
   response.raise_for_status()
 
   # Wait until group has been exported
-  print(f'- Waiting for group {source} to be exported...')
+  log(f'- Waiting for group {source} to be exported...')
   exported = False
   while not exported:
     try:
-      response = requests.get(
+      response = SRC_SCHEDULER.request('get', 'export',
         url = f'{SRC_GITLAB_URL}/api/v4/groups/{source_url_safe}/export/download',
         headers = headers,
         verify = TLS_VERIFY,
@@ -225,15 +500,15 @@ def export_group(source):
       )
       response.raise_for_status()
       
-      print(f'  - Group {source} export status is ready and downloaded.')
+      log(f'  - Group {source} export status is ready and downloaded.')
       group_data = response.content
       exported = True
 
     except Exception as e:
-      print(f'  - Group {source} export status is not ready (404 not found is expected): {e}')
+      log(f'  - Group {source} export status is not ready (404 not found is expected): {e}')
       time.sleep(1)
 
-  print('- Successfully exported group.')
+  log('- Successfully exported group.')
 
   return (detected_source_group_path, detected_source_group_name, group_data)
 
@@ -247,13 +522,13 @@ def import_group(dest_path, dest_name, group_data):
   dest_name: name of group
   group_data: the contents of the exported group.
   '''
-  print(f'Importing group to path={dest_path}, name={dest_name}.')
+  log(f'Importing group to path={dest_path}, name={dest_name}.')
 
   headers = {
     'PRIVATE-TOKEN': f'{DST_TOKEN}'
   }
   files = {
-    'file': ('file.tar.gz', BytesIO(group_data))
+    'file': ('file.tar.gz', group_data)
   }
   data = {
     "path": dest_path,
@@ -264,11 +539,11 @@ def import_group(dest_path, dest_name, group_data):
   if len(dest_path.split("/")) > 1:
     detected_dest_parent_path = dest_path.rsplit("/", 1)[0]
     detected_dest_child_path = dest_path.rsplit("/", 1)[1]
-    print(f'- Detected parent group path = {detected_dest_parent_path}, child group path = {detected_dest_child_path}.')
+    log(f'- Detected parent group path = {detected_dest_parent_path}, child group path = {detected_dest_child_path}.')
 
     # Detect the dest parent id
     detected_dest_parent_path_url_safe = urllib.parse.quote_plus(detected_dest_parent_path)
-    response = requests.get(
+    response = DST_SCHEDULER.request('get', 'metadata',
       url = f'{DST_GITLAB_URL}/api/v4/groups/{detected_dest_parent_path_url_safe}',
       headers = headers,
       verify = TLS_VERIFY,
@@ -280,9 +555,9 @@ def import_group(dest_path, dest_name, group_data):
     # Amend path and parent_id
     data["path"] = detected_dest_child_path
     data["parent_id"] = detected_dest_parent_id
-    print(f'- Detected parent_id: {detected_dest_parent_id}.')
+    log(f'- Detected parent_id: {detected_dest_parent_id}.')
     
-  response = requests.post(
+  response = DST_SCHEDULER.request('post', 'import',
     url = f'{DST_GITLAB_URL}/api/v4/groups/import',
     headers = headers,
     data = data,
@@ -292,85 +567,199 @@ def import_group(dest_path, dest_name, group_data):
   )
   response.raise_for_status()
 
-  print('- Successfully imported group.')
+  log('- Successfully imported group.')
+
 
+def wait_for_namespace(dest_namespace):
+  '''
+  Waits until a group exists in dest. Group imports are processed asynchronously,
+  so subgroups may appear some time after import_group returns:
+  https://docs.gitlab.com/ee/api/groups.html#details-of-a-group
 
-def modify_repo(project_data):
+  dest_namespace: full path of group
+  '''
+  log(f'Waiting for namespace {dest_namespace} to exist.')
+  dest_namespace_url_safe = urllib.parse.quote_plus(dest_namespace)
+
+  headers = {
+    'PRIVATE-TOKEN': f'{DST_TOKEN}'
+  }
+
+  while True:
+    response = DST_SCHEDULER.request('get', 'metadata',
+      url = f'{DST_GITLAB_URL}/api/v4/groups/{dest_namespace_url_safe}',
+      headers = headers,
+      verify = TLS_VERIFY,
+      timeout = 600,
+    )
+    if response.status_code != 404:
+      break
+
+    log(f'- Namespace {dest_namespace} does not exist yet.')
+    time.sleep(1)
+
+  response.raise_for_status()
+  log(f'- Namespace {dest_namespace} exists.')
+
+
+# git-filter-repo keeps module-level state and changes the working directory, so only one rewrite runs at a time
+FILTER_REPO_LOCK = threading.Lock()
+
+def modify_repo(project_file):
   '''
   Modify a git repo from Gitlab project export bundle using git-filter-repo.
+  The project export is modified in place.
+
+  project_file: path to the exported project
+  returns: bundle_heads as returned by list_bundle_heads, or None if there is no git repo
   '''
 
-  print('Modifying repo')
+  log('Modifying repo')
   with tempfile.TemporaryDirectory() as tmpdirname:
-    print('- Created temporary directory', tmpdirname)
-
-    # Save to tempdir/file.tar.gz
-    print('- Saving project tar file')
-    tarfilename = "file.tar.gz"
-    with open(f'{tmpdirname}/{tarfilename}', 'wb') as tarfile:
-      tarfile.write(project_data)
-      tarfile.flush()
-      os.fsync(tarfile)
+    log('- Created temporary directory', tmpdirname)
 
     # tar -zxvf file.tar.gz
-    print('- Untar-ing file')
-    subprocess.check_output([ "/usr/bin/tar", "-zx", "-C", tmpdirname, "-f", f"{tmpdirname}/{tarfilename}" ])
-
-    print('------------------------------------------')
-    # git clone project.bundle
-    if os.path.exists(f"{tmpdirname}/project.bundle"):
-      print('- git clone project.bundle')
-      subprocess.check_output([ f"{GIT_BINARY}", "-C", tmpdirname, "clone", "project.bundle" ])
+    log('- Untar-ing file')
+    subprocess.check_output([ "/usr/bin/tar", "-zx", "-C", tmpdirname, "-f", project_file ])
+
+    log('------------------------------------------')
+    if not os.path.exists(f"{tmpdirname}/project.bundle"):
+      log('- Not modifying repo because no git repo found!')
+      return None
+
+    # Reuse the modified project.bundle if this bundle was modified before with the same users
+    key = cache_key(f"{tmpdirname}/project.bundle") if CACHE_MAX_BYTES > 0 else None
+    if key != None and cache_get(key, f"{tmpdirname}/project.bundle"):
+      log(f'- Using cached modified project.bundle {key}')
     else:
-      print('- Not modifying repo because no git repo found!')
-      return project_data
-
-    print('------------------------------------------')
-    # python3 modify-repo -m -r project/
-    print('- modifying repo')
-    modify_gitrepo.FORCE = False
-    modify_gitrepo.modify_repo(f"{tmpdirname}/project")
-    
-    print('------------------------------------------')
-    # git -C project/ bundle create project.bundle --all
-    print('- git recreate project.bundle')
-    subprocess.check_output([ f"{GIT_BINARY}", "-C", f"{tmpdirname}/project", "bundle", "create", f"{tmpdirname}/project.bundle", "--all" ])
-    
-    print('------------------------------------------')
-    # rm file.tar.gz
-    # rm -rf project
-    print('- delete project folder')
-    shutil.rmtree(f'{tmpdirname}/project')
+      # git clone project.bundle
+      log('- git clone project.bundle')
+      subprocess.check_output([ f"{GIT_BINARY}", "-C", tmpdirname, "clone", "project.bundle" ])
+
+      log('------------------------------------------')
+      # python3 modify-repo -m -r project/
+      log('- modifying repo')
+      with FILTER_REPO_LOCK:
+        modify_gitrepo.FORCE = False
+        modify_gitrepo.modify_repo(f"{tmpdirname}/project")
+
+      log('------------------------------------------')
+      # git -C project/ bundle create project.bundle --all
+      log('- git recreate project.bundle')
+      subprocess.check_output([ f"{GIT_BINARY}", "-C", f"{tmpdirname}/project", "bundle", "create", f"{tmpdirname}/project.bundle", "--all" ])
+      if key != None:
+        cache_put(key, f"{tmpdirname}/project.bundle")
+
+      log('------------------------------------------')
+      # rm -rf project
+      log('- delete project folder')
+      shutil.rmtree(f'{tmpdirname}/project')
+
+    bundle_heads = list_bundle_heads(f"{tmpdirname}/project.bundle")
 
     # tar -zcvf file.tar.gz .
-    print('- Tar-ing file')
-    subprocess.check_output([ "/usr/bin/tar", "-zc",  f"--exclude={tarfilename}", "-C", tmpdirname, "-f", f"{tmpdirname}/file.tar.gz", "." ])
+    log('- Tar-ing file')
+    subprocess.check_output([ "/usr/bin/tar", "-zc", "-C", tmpdirname, "-f", project_file, "." ])
+
+    return bundle_heads
+
+
+CACHE_LOCK = threading.Lock()
+
+def cache_key(bundle_path):
+  '''
+  Returns the cache key of a project.bundle: the sha256 of the bundle header and of the users mapping in modify-gitrepo.py.
+  The header lists the refs with their shas and any prerequisite commits, which identify the bundle content
+  even when an unchanged project is exported with a differently packed bundle.
+
+  bundle_path: path to the unmodified project.bundle
+  '''
+  # The header ends with an empty line, followed by the pack data
+  header = []
+  with open(bundle_path, 'rb') as bundle:
+    for line in bundle:
+      if line == b'\n':
+        break
+      header.append(line)
+  bundle_hash = hashlib.sha256(b''.join(sorted(header)))
+
+  users_hash = hashlib.sha256(repr(sorted(modify_gitrepo.USERS.items())).encode('utf-8'))
+
+  return f'{bundle_hash.hexdigest()}-{users_hash.hexdigest()}'
+
+
+def cache_get(key, bundle_path):
+  '''
+  Copies the cached modified bundle to bundle_path if present, and marks it as recently used.
 
-    # Load modfied export
-    print('- Load modified project data')
-    with open(f'{tmpdirname}/file.tar.gz', 'rb') as tarfile:
-      modified_project_data = tarfile.read()
+  key: key from cache_key
+  bundle_path: path to write the modified project.bundle
+  returns: True on a cache hit
+  '''
+  cached_path = f'{CACHE_DIR}/{key}.bundle'
+  try:
+    os.utime(cached_path)
+    shutil.copyfile(cached_path, bundle_path)
+  except FileNotFoundError:
+    return False
+  return True
 
-    return modified_project_data
 
+def cache_put(key, bundle_path):
+  '''
+  Stores a modified bundle in the cache, then evicts the least recently used bundles above CACHE_MAX_BYTES.
 
+  key: key from cache_key
+  bundle_path: path to the modified project.bundle
+  '''
+  os.makedirs(CACHE_DIR, exist_ok = True)
 
-def export_project(source):
+  # Write to a temporary file first so a partially written bundle is never read
+  (fd, tmp_path) = tempfile.mkstemp(dir = CACHE_DIR, suffix = '.tmp')
+  os.close(fd)
+  try:
+    shutil.copyfile(bundle_path, tmp_path)
+    os.replace(tmp_path, f'{CACHE_DIR}/{key}.bundle')
+  finally:
+    if os.path.exists(tmp_path):
+      os.remove(tmp_path)
+
+  with CACHE_LOCK:
+    entries = []
+    for entry in os.scandir(CACHE_DIR):
+      if entry.name.endswith('.bundle'):
+        stat = entry.stat()
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total_size = sum(size for (mtime, size, path) in entries)
+    for (mtime, size, path) in sorted(entries):
+      if total_size <= CACHE_MAX_BYTES:
+        break
+      log(f'- Evicting cached bundle {os.path.basename(path)}')
+      try:
+        os.remove(path)
+      except FileNotFoundError:
+        pass
+      total_size = total_size - size
+
+
+def export_project(source, project_file):
   '''
   Detects the source project path and exports the project data:
   https://docs.gitlab.com/ee/api/project_import_export.html#schedule-an-export
 
   source: source project in format project_id or namespace/project (full path).
-  returns: (detected_source_project_path, detected_source_project_name, project_data)
+  project_file: path to download the exported project to
+  returns: (detected_source_project_path, detected_source_project_name)
   '''
-  print(f'Exporting project from: {source}.')
+  log(f'Exporting project from: {source}.')
   source_url_safe = urllib.parse.quote_plus(source)
 
   # Detect the source project path
   headers = {
     'PRIVATE-TOKEN': f'{SRC_TOKEN}'
   }
-  response = requests.get(
+  response = SRC_SCHEDULER.request('get', 'metadata',
     url = f'{SRC_GITLAB_URL}/api/v4/projects/{source_url_safe}',
     headers = headers,
     verify = TLS_VERIFY,
@@ -379,11 +768,11 @@ def export_project(source):
   response.raise_for_status()
   detected_source_project_path = response.json()['path_with_namespace']
   detected_source_project_name = response.json()['name']
-  print(f'- Detected path is: {detected_source_project_path}, detected name is: {detected_source_project_name}.')
+  log(f'- Detected path is: {detected_source_project_path}, detected name is: {detected_source_project_name}.')
 
   # Initiate export
-  print(f'- Initiating export for project {source}...')
-  response = requests.post(
+  log(f'- Initiating export for project {source}...')
+  response = SRC_SCHEDULER.request('post', 'export',
     url = f'{SRC_GITLAB_URL}/api/v4/projects/{source_url_safe}/export',
     headers = headers,
     verify = TLS_VERIFY,
@@ -392,10 +781,10 @@ def export_project(source):
   response.raise_for_status()
 
   # Wait until project has been exported
-  print(f'- Waiting for project {source} to be exported...')
+  log(f'- Waiting for project {source} to be exported...')
   exported = False
   while not exported:
-    response = requests.get(
+    response = SRC_SCHEDULER.request('get', 'metadata',
       url = f'{SRC_GITLAB_URL}/api/v4/projects/{source_url_safe}/export',
       headers = headers,
       verify = TLS_VERIFY,
@@ -403,70 +792,71 @@ def export_project(source):
     )
     response.raise_for_status()
     if response.json()['export_status'] != "finished":
-      print(f'  - Project {source} export status is not ready...')
+      log(f'  - Project {source} export status is not ready...')
       time.sleep(1)
     else:
-      print(f'  - Project {source} export status is ready.')
+      log(f'  - Project {source} export status is ready.')
       exported = True
 
   # Download project data
-  print(f'- Downloading project {source}.')
-  response = requests.get(
+  log(f'- Downloading project {source}.')
+  response = SRC_SCHEDULER.request('get', 'export',
+    output_file = project_file,
     url = f'{SRC_GITLAB_URL}/api/v4/projects/{source_url_safe}/export/download',
     headers = headers,
     verify = TLS_VERIFY,
     timeout = 600,
   )
   response.raise_for_status()
-  project_data = response.content
 
-  print('- Successfully exported project.')
+  log('- Successfully exported project.')
 
-  return (detected_source_project_path, detected_source_project_name, project_data)
+  return (detected_source_project_path, detected_source_project_name)
 
 
-def import_project(dest_path, dest_name, project_data):
+def import_project(dest_path, dest_name, project_file):
   '''
   Imports project data into a dest_path and dest_name: 
   https://docs.gitlab.com/ee/api/project_import_export.html#import-a-file
 
   dest_path: full path of project = namespace/project_path
   dest_name: name of project
-  project_data: the contents of the exported project
+  project_file: path to the exported project
   '''
-  print(f'Importing project to path={dest_path}, name={dest_name}.')
+  log(f'Importing project to path={dest_path}, name={dest_name}.')
   
   # Extract namespace
   if len(dest_path.rsplit("/", 1)) != 2:
-    print(f'- Unable to split {dest_path} with delimiter = /.')
+    log(f'- Unable to split {dest_path} with delimiter = /.')
     sys.exit(1)
 
   dest_namespace = dest_path.rsplit("/", 1)[0]
   dest_project_path = dest_path.rsplit("/", 1)[1]
-  print(f'- Extracted namespace={dest_namespace}, project path={dest_project_path}.')
+  log(f'- Extracted namespace={dest_namespace}, project path={dest_project_path}.')
 
   headers = {
     'PRIVATE-TOKEN': f'{DST_TOKEN}'
   }
-  files = {
-    'file': ('file.tar.gz', BytesIO(project_data))
-  }
   data = {
     "namespace": dest_namespace,
     "name": dest_name,
     "path": dest_project_path,
   }
-  response = requests.post(
-    url = f'{DST_GITLAB_URL}/api/v4/projects/import',
-    headers = headers,
-    data = data,
-    files = files,
-    verify = TLS_VERIFY,
-    timeout = 600,
-  )
+  with open(project_file, 'rb') as file:
+    files = {
+      'file': ('file.tar.gz', file)
+    }
+    response = DST_SCHEDULER.request('post', 'import',
+      url = f'{DST_GITLAB_URL}/api/v4/projects/import',
+      headers = headers,
+      data = data,
+      files = files,
+      verify = TLS_VERIFY,
+      timeout = 600,
+    )
   response.raise_for_status()
 
-  print('- Successfully imported project.')
+  log('- Successfully imported project.')
 
 
 def migrate_ci_variables(source, dest_path):
@@ -478,13 +868,13 @@ def migrate_ci_variables(source, dest_path):
   '''
 
   # Export project variables
-  print(f'Exporting CI variables from: {source}.')
+  log(f'Exporting CI variables from: {source}.')
   source_url_safe = urllib.parse.quote_plus(source)
 
   headers = {
     'PRIVATE-TOKEN': f'{SRC_TOKEN}'
   }
-  response = requests.get(
+  response = SRC_SCHEDULER.request('get', 'metadata',
     url = f'{SRC_GITLAB_URL}/api/v4/projects/{source_url_safe}/variables',
     headers = headers,
     verify = TLS_VERIFY,
@@ -494,7 +884,7 @@ def migrate_ci_variables(source, dest_path):
   ci_variables = response.json()
 
   # Import project variables
-  print(f'Importing CI variables to: {dest_path}.')
+  log(f'Importing CI variables to: {dest_path}.')
   dest_url_safe = urllib.parse.quote_plus(dest_path)
 
   headers = {
@@ -502,8 +892,8 @@ def migrate_ci_variables(source, dest_path):
   }
 
   for data in ci_variables:
-    print(f'- Importing CI Variable: {data["key"]}')
-    response = requests.post(
+    log(f'- Importing CI Variable: {data["key"]}')
+    response = DST_SCHEDULER.request('post', 'metadata',
       url = f'{DST_GITLAB_URL}/api/v4/projects/{dest_url_safe}/variables',
       headers = headers,
       data = data,
@@ -513,18 +903,236 @@ def migrate_ci_variables(source, dest_path):
     response.raise_for_status()
 
 
+def list_bundle_heads(bundle_path):
+  '''
+  Lists the branches and tags in a project.bundle.
+
+  bundle_path: path to the project.bundle
+  returns: dict of ref name (eg. refs/heads/main) to sha
+  '''
+  output = subprocess.check_output([ f"{GIT_BINARY}", "bundle", "list-heads", bundle_path ])
+
+  bundle_heads = {}
+  for line in output.decode('utf-8').splitlines():
+    (sha, ref) = line.split(" ", 1)
+    if ref.startswith("refs/heads/") or ref.startswith("refs/tags/"):
+      bundle_heads[ref] = sha
+  return bundle_heads
+
+
+def get_all_pages(scheduler, url, headers, params = {}):
+  '''
+  Gets all items of a paginated list: https://docs.gitlab.com/ee/api/index.html#pagination
+  Follows x-next-page, as x-total-pages is omitted for lists of more than 10,000 items.
+
+  scheduler: SRC_SCHEDULER or DST_SCHEDULER
+  url: url of the list endpoint
+  headers: request headers
+  params: [optional] additional query parameters
+  returns: list of items
+  '''
+  items = []
+  current_page = "1"
+  while current_page:
+    response = scheduler.request('get', 'metadata',
+      url = url,
+      headers = headers,
+      params = { **params, "page": current_page, "per_page": 100 },
+      verify = TLS_VERIFY,
+      timeout = 600,
+    )
+    response.raise_for_status()
+    items.extend(response.json())
+    current_page = response.headers.get("x-next-page")
+
+  return items
+
+
+def wait_for_project_import(dest_path):
+  '''
+  Waits until the project import in dest has completed:
+  https://docs.gitlab.com/ee/api/project_import_export.html#import-status
+
+  dest_path: full path of project = namespace/project_path
+  returns: import error message, or None if the import finished
+  '''
+  dest_url_safe = urllib.parse.quote_plus(dest_path)
+  headers = {
+    'PRIVATE-TOKEN': f'{DST_TOKEN}'
+  }
+
+  while True:
+    response = DST_SCHEDULER.request('get', 'metadata',
+      url = f'{DST_GITLAB_URL}/api/v4/projects/{dest_url_safe}/import',
+      headers = headers,
+      verify = TLS_VERIFY,
+      timeout = 600,
+    )
+    response.raise_for_status()
+    import_status = response.json()['import_status']
+    if import_status == "finished":
+      return None
+    elif import_status == "failed":
+      return response.json().get('import_error') or 'unknown error'
+
+    log(f'  - Project {dest_path} import status is {import_status}...')
+    time.sleep(1)
+
+
+# Seconds to wait for the dest project statistics to be updated after an import
+STATISTICS_TIMEOUT = 600
+
+def get_project_statistics(scheduler, url, headers):
+  '''
+  Gets the statistics of a project: https://docs.gitlab.com/ee/api/projects.html#get-single-project
+
+  scheduler: SRC_SCHEDULER or DST_SCHEDULER
+  url: url of the project
+  headers: request headers
+  returns: dict of statistics
+  '''
+  response = scheduler.request('get', 'metadata',
+    url = url,
+    headers = headers,
+    params = { "statistics": True },
+    verify = TLS_VERIFY,
+    timeout = 600,
+  )
+  response.raise_for_status()
+  return response.json().get('statistics', {})
+
+
+def verify_project(source, dest_path, bundle_heads):
+  '''
+  Compares a migrated project in dest with source, without cloning either side:
+  - branches and tags in dest against the heads of the modified project.bundle
+  - commit count and LFS size from the project statistics
+  - CI variable keys
+
+  source: source project in format project_id or namespace/project (full path).
+  dest_path: full path of project = namespace/project_path
+  bundle_heads: heads of the modified project.bundle as returned by list_bundle_heads
+  returns: list of mismatches
+  '''
+  with log_prefix(f'[verify {source}] '):
+    log(f'Verifying project {source} against {dest_path}.')
+    source_url_safe = urllib.parse.quote_plus(source)
+    dest_url_safe = urllib.parse.quote_plus(dest_path)
+    src_headers = {
+      'PRIVATE-TOKEN': f'{SRC_TOKEN}'
+    }
+    dst_headers = {
+      'PRIVATE-TOKEN': f'{DST_TOKEN}'
+    }
+    mismatches = []
+
+    import_error = wait_for_project_import(dest_path)
+    if import_error != None:
+      return [ f'import failed: {import_error}' ]
+
+    # Refs and tip SHAs
+    if bundle_heads != None:
+      dest_heads = {}
+      for branch in get_all_pages(DST_SCHEDULER, f'{DST_GITLAB_URL}/api/v4/projects/{dest_url_safe}/repository/branches', dst_headers):
+        dest_heads[f'refs/heads/{branch["name"]}'] = branch['commit']['id']
+      # Annotated tags are listed in the bundle by the tag object, which is the target
+      for tag in get_all_pages(DST_SCHEDULER, f'{DST_GITLAB_URL}/api/v4/projects/{dest_url_safe}/repository/tags', dst_headers):
+        dest_heads[f'refs/tags/{tag["name"]}'] = tag['target']
+
+      for ref in sorted(set(bundle_heads) | set(dest_heads)):
+        if ref not in dest_heads:
+          mismatches.append(f'{ref} missing in dest')
+        elif ref not in bundle_heads:
+          mismatches.append(f'{ref} not in modified bundle')
+        elif bundle_heads[ref] != dest_heads[ref]:
+          mismatches.append(f'{ref} is {dest_heads[ref]} in dest, expected {bundle_heads[ref]}')
+
+    # Repository statistics. Repository size is expected to differ after modification, so it is not compared.
+    # Dest statistics are updated asynchronously after the import, so wait until they are filled in.
+    statistics_keys = [ 'commit_count', 'lfs_objects_size' ]
+    src_statistics = get_project_statistics(SRC_SCHEDULER, f'{SRC_GITLAB_URL}/api/v4/projects/{source_url_safe}', src_headers)
+    deadline = time.time() + STATISTICS_TIMEOUT
+    while True:
+      dst_statistics = get_project_statistics(DST_SCHEDULER, f'{DST_GITLAB_URL}/api/v4/projects/{dest_url_safe}', dst_headers)
+      pending = [ key for key in statistics_keys if src_statistics.get(key) and not dst_statistics.get(key) ]
+      if not pending or time.time() >= deadline:
+        break
+      log(f'  - Project {dest_path} statistics are not updated yet: {pending}...')
+      time.sleep(5)
+
+    for key in statistics_keys:
+      if src_statistics.get(key) != dst_statistics.get(key):
+        mismatches.append(f'{key} is {dst_statistics.get(key)} in dest, {src_statistics.get(key)} in source')
+
+    # CI variable keys
+    ci_variable_keys = []
+    for (scheduler, url, headers) in [
+      (SRC_SCHEDULER, f'{SRC_GITLAB_URL}/api/v4/projects/{source_url_safe}/variables', src_headers),
+      (DST_SCHEDULER, f'{DST_GITLAB_URL}/api/v4/projects/{dest_url_safe}/variables', dst_headers),
+    ]:
+      ci_variables = get_all_pages(scheduler, url, headers)
+      ci_variable_keys.append(set((data['key'], data.get('environment_scope', '*')) for data in ci_variables))
+
+    for (key, environment_scope) in sorted(ci_variable_keys[0] - ci_variable_keys[1]):
+      mismatches.append(f'CI variable {key} (scope {environment_scope}) missing in dest')
+    for (key, environment_scope) in sorted(ci_variable_keys[1] - ci_variable_keys[0]):
+      mismatches.append(f'CI variable {key} (scope {environment_scope}) not in source')
+
+    return mismatches
+
+
+def verify_projects(migrated_projects):
+  '''
+  Verifies migrated projects in parallel and prints a single mismatch report.
+  Projects that failed to migrate are reported without being verified.
+
+  migrated_projects: list of (source, dest_path, bundle_heads, error) as returned by migrate_project or migrate_group
+  returns: number of projects with mismatches or failures
+  '''
+  with ThreadPoolExecutor(max_workers = MAX_WORKERS) as executor:
+    futures = [
+      executor.submit(verify_project, source, dest_path, bundle_heads) if error == None else None
+      for (source, dest_path, bundle_heads, error) in migrated_projects
+    ]
+    results = []
+    for ((source, dest_path, bundle_heads, error), future) in zip(migrated_projects, futures):
+      if error != None:
+        results.append((source, dest_path, [ f'migration failed: {error}' ]))
+        continue
+      try:
+        results.append((source, dest_path, future.result()))
+      except Exception as e:
+        results.append((source, dest_path, [ f'verification failed: {e}' ]))
+
+  log('---------------------------------------------------------------------------')
+  log('Verification report')
+  failed = 0
+  for (source, dest_path, mismatches) in results:
+    if mismatches:
+      failed = failed + 1
+      log(f'- {source} -> {dest_path}: {len(mismatches)} mismatches')
+      for mismatch in mismatches:
+        log(f'  - {mismatch}')
+    else:
+      log(f'- {source} -> {dest_path}: OK')
+  log(f'{len(results) - failed} of {len(results)} projects verified, {failed} with mismatches.')
+
+  return failed
+
+
 def print_help():
   print("This script assists in migrating a git repo between gitlab instances.\n"
   "\n"
   "Usage\n"
   "-------------\n"
-  "python3 gitlab-api.py <-g|-p> <-s source> [-a] [--dest-path dest_path] [--dest-name dest_name]\n"
+  "python3 gitlab-api.py <-g|-p> <-s source> [-a] [-v] [--dest-path dest_path] [--dest-name dest_name]\n"
   "\n"
   "Options\n"
   "-------------\n"
   "-g: migrate group.\n"
   "-p: migrate project.\n"
   "-a: migrate all projects in group.\n"
+  "-v: verify migrated projects against source and print a mismatch report.\n"
   "-s: source - id or full path of group or project (eg. 113 or my-namespace/my-project).\n"
   "--dest-path: full path of destination group or project (eg. my-namespace/my-project). Autodetected if not provided.\n"
   "--dest-name: name of destination group or project (eg. 'My Project'). Autodetected if not provided."
@@ -537,9 +1145,9 @@ def print_help():
 
 def main():
   try:
-    opts, args = getopt.getopt(sys.argv[1:], "gpas:", ["dest-path=","dest-name="])
+    opts, args = getopt.getopt(sys.argv[1:], "gpavs:", ["dest-path=","dest-name="])
   except getopt.GetoptError as err:
-    print(err)
+    log(err)
     print_help()
     sys.exit(1)
 
@@ -553,6 +1161,7 @@ def main():
   source = None
   dest_path = None
   dest_name = None
+  verify = False
   for key, value in opts:
     if key == "-g":
       migrate_action = Action.MIGRATE_GROUP
@@ -560,6 +1169,8 @@ def main():
       migrate_action = Action.MIGRATE_PROJECT
     elif key == "-a":
       migrate_action = Action.MIGRATE_GROUP_PROJECTS
+    elif key == "-v":
+      verify = True
     elif key == "-s":
       source = value
     elif key == "--dest-path":
@@ -567,26 +1178,45 @@ def main():
     elif key == "--dest-name":
       dest_name = value
     else:
-      print(f"Error: Unhandled option {key}")
+      log(f"Error: Unhandled option {key}")
       sys.exit(1)
     
   # Check that necessary config are set
   if not migrate_action or not source:
-    print("Error: Some values were not set.")
+    log("Error: Some values were not set.")
+    print_help()
+    sys.exit(1)
+
+  if verify and migrate_action == Action.MIGRATE_GROUP:
+    log("Error: -v verifies projects, use it with -p or -a.")
     print_help()
     sys.exit(1)
 
   # Perform repo action
+  migrated_projects = []
   if migrate_action == Action.MIGRATE_GROUP:
     migrate_group(source, dest_path, dest_name)
   elif migrate_action == Action.MIGRATE_PROJECT:
-    migrate_project(source, dest_path, dest_name)
+    migrated_projects.append(migrate_project(source, dest_path, dest_name))
   elif migrate_action == Action.MIGRATE_GROUP_PROJECTS:
     if dest_path != None:
-      print(f"Migrating projects is not supported when group dest_path={dest_path} is different from source={source}.")
-      print(f"Move group in source gitlab to desired location first, then perform group migration with projects again.")
+      log(f"Migrating projects is not supported when group dest_path={dest_path} is different from source={source}.")
+      log(f"Move group in source gitlab to desired location first, then perform group migration with projects again.")
+      sys.exit(1)
+    migrated_projects = migrate_group(source, dest_path, dest_name, projects=True)
+
+  # Verify migrated projects
+  if verify:
+    if verify_projects(migrated_projects) > 0:
+      sys.exit(1)
+  else:
+    failed_projects = [ (source, error) for (source, dest_path, bundle_heads, error) in migrated_projects if error != None ]
+    if failed_projects:
+      log('---------------------------------------------------------------------------')
+      log(f'{len(failed_projects)} of {len(migrated_projects)} projects failed to migrate:')
+      for (source, error) in failed_projects:
+        log(f'- {source}: {error}')
       sys.exit(1)
-    migrate_group(source, dest_path, dest_name, projects=True)
 
 if __name__ == "__main__":
   main()
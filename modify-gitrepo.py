@@ -3,6 +3,8 @@
 import getopt, sys
 from enum import Enum, auto
 import os
+import collections
+import subprocess
 import git_filter_repo
 
 '''
@@ -18,37 +20,59 @@ def callback_get_author_names(commit, metadata):
   AUTHORS.add(commit.author_name)
 
 
-def callback_modify_repo(commit, metadata):
-  # Map of user to userinfo
-  users = {
-    b"olduser_1" : {
-      "new_name" : b"modified - olduser1",
-      "new_email" : b"modified-olduser1@nowhere.com",
-    },
-    b"olduser_2" : {
-      "new_name" : b"modified - olduser2",
-      "new_email" : b"modified-olduser2@nowhere.com",
-    },
-  }
+# Map of user to userinfo
+USERS = {
+  b"olduser_1" : {
+    "new_name" : b"modified - olduser1",
+    "new_email" : b"modified-olduser1@nowhere.com",
+  },
+  b"olduser_2" : {
+    "new_name" : b"modified - olduser2",
+    "new_email" : b"modified-olduser2@nowhere.com",
+  },
+}
 
+def callback_modify_repo(commit, metadata):
   # --- Debugging ---
-  # if commit.author_name in users:
-  #   print(f'{users[commit.author_name]["new_name"]}')
+  # if commit.author_name in USERS:
+  #   print(f'{USERS[commit.author_name]["new_name"]}')
 
   # Replace parameters for users matching author_name in each commit
-  if commit.author_name in users:
-    userinfo = users[commit.author_name]
+  if commit.author_name in USERS:
+    userinfo = USERS[commit.author_name]
     commit.author_name = userinfo["new_name"]
     commit.author_email = userinfo["new_email"]
     commit.committer_name = userinfo["new_name"]
     commit.committer_email = userinfo["new_email"]
 
 
+# Statistics gathered by callback_process_repo. Blob ids are shas as fast-export runs with --no-data.
+STATS = {
+  'num_commits': 0,
+  'authors': collections.Counter(),       # (name, email) -> commits, before modification
+  'modified_authors': {},                 # (name, email) -> (new_name, new_email)
+  'path_blobs': collections.defaultdict(set), # path -> unique blob ids
+}
+def callback_process_repo(commit, metadata):
+  author = (commit.author_name, commit.author_email)
+  STATS['num_commits'] += 1
+  STATS['authors'][author] += 1
+
+  for change in commit.file_changes:
+    if change.type == b'M':
+      STATS['path_blobs'][change.filename].add(change.blob_id)
+
+  callback_modify_repo(commit, metadata)
+  if (commit.author_name, commit.author_email) != author:
+    STATS['modified_authors'][author] = (commit.author_name, commit.author_email)
+
+
 # ---------------------------------------------------------------------------
 class Action(Enum):
   GET_USERS = auto()
   MODIFY_REPO = auto()
   ANALYZE_REPO = auto()
+  PROCESS_REPO = auto()
 
 '''
 git_filter_repo.FilteringOptions.default_options():
@@ -133,6 +157,85 @@ def analyze_repo(repo_path, report_folder):
   git_filter_repo.RepoAnalyze.run(args)
 
 
+def get_present_paths():
+  '''
+  Returns the set of paths present in the commits that refs of the repo in the current directory point to.
+  Refs often share a tree, eg. merge request and keep-around refs, so each unique tree is listed once.
+  '''
+  trees = set(subprocess.check_output([ 'git', 'log', '--no-walk', '--all', '--format=%T' ]).split())
+
+  present_paths = set()
+  for tree in trees:
+    paths = subprocess.check_output([ 'git', 'ls-tree', '-r', '-z', '--name-only', tree ])
+    present_paths.update(path for path in paths.split(b'\0') if path)
+  return present_paths
+
+
+def process_repo(repo_path, report_folder):
+  '''
+  Gets users, modifies commit history and analyzes the repo in a single pass over history.
+  Writes report.txt to report_folder.
+  '''
+  # Get absolute path of report folder as we will be changing directory
+  report_folder_abs = os.path.abspath(report_folder)
+
+  # Blob sizes are read from the object database, which the history rewrite does not change
+  os.chdir(repo_path)
+  unpacked_size, packed_size = git_filter_repo.GitUtils.get_blob_sizes(quiet = True)
+
+  # source == target makes fast-export skip blob contents (--no-data)
+  args = git_filter_repo.FilteringOptions.default_options()
+  args.source = b'.'
+  args.target = b'.'
+  args.replace_refs = '--update-no-add'
+  args.preserve_commit_hashes = True
+  args.force = True if FORCE else False
+  filter = git_filter_repo.RepoFilter(args, commit_callback = callback_process_repo)
+  filter.run()
+
+  # A path is deleted if it is not present in any ref
+  present_paths = get_present_paths()
+
+  # Size of a path is the total size of all unique blobs it ever held
+  path_sizes = {}
+  extension_sizes = collections.defaultdict(lambda: [0, 0])
+  for path, blob_ids in STATS['path_blobs'].items():
+    path_unpacked = sum(unpacked_size.get(blob_id, 0) for blob_id in blob_ids)
+    path_packed = sum(packed_size.get(blob_id, 0) for blob_id in blob_ids)
+    path_sizes[path] = (path_unpacked, path_packed)
+    extension = os.path.splitext(path)[1] or b'<no extension>'
+    extension_sizes[extension][0] += path_unpacked
+    extension_sizes[extension][1] += path_packed
+
+  os.makedirs(report_folder_abs, exist_ok = True)
+  with open(os.path.join(report_folder_abs, 'report.txt'), 'w') as report:
+    report.write('== Summary ==\n')
+    report.write(f'Commits: {STATS["num_commits"]}\n')
+    report.write(f'Blobs: {len(unpacked_size)}\n')
+    report.write(f'Total unpacked size (bytes): {sum(unpacked_size.values())}\n')
+    report.write(f'Total packed size (bytes): {sum(packed_size.values())}\n')
+    report.write(f'Authors: {len(STATS["authors"])}, modified: {len(STATS["modified_authors"])}\n')
+
+    report.write('\n== Authors (commits, name <email> [-> new name <new email>]) ==\n')
+    for (name, email), count in STATS['authors'].most_common():
+      line = f'{count:>10} {name.decode(errors="replace")} <{email.decode(errors="replace")}>'
+      if (name, email) in STATS['modified_authors']:
+        (new_name, new_email) = STATS['modified_authors'][(name, email)]
+        line += f' -> {new_name.decode(errors="replace")} <{new_email.decode(errors="replace")}>'
+      report.write(line + '\n')
+
+    report.write('\n== Extensions by size (unpacked, packed, extension) ==\n')
+    for extension, (ext_unpacked, ext_packed) in sorted(extension_sizes.items(), key = lambda item: item[1][1], reverse = True):
+      report.write(f'{ext_unpacked:>12} {ext_packed:>12} {extension.decode(errors="replace")}\n')
+
+    report.write('\n== Paths by size (unpacked, packed, path [deleted]) ==\n')
+    for path, (path_unpacked, path_packed) in sorted(path_sizes.items(), key = lambda item: item[1][1], reverse = True):
+      deleted = '' if path in present_paths else ' [deleted]'
+      report.write(f'{path_unpacked:>12} {path_packed:>12} {path.decode(errors="replace")}{deleted}\n')
+
+  print(f'Report written to: {os.path.join(report_folder_abs, "report.txt")}')
+
+
 def print_help():
   print("This script assists in modifying commit history.\n"
   "\n"
@@ -141,6 +244,7 @@ def print_help():
   "Get all unique users in repo: modify-gitrepo.py -u -r <repo_path>\n"
   "Modify commit history       : modify-gitrepo.py -m -r <repo_path>\n"
   "Analyze Repo                : modify-gitrepo.py -a <report_folder> -r <repo_path>\n"
+  "All of the above in one pass: modify-gitrepo.py -c <report_folder> -r <repo_path>\n"
   "-----\n"
   "Global Options\n"
   "-f : force\n"
@@ -149,7 +253,7 @@ def print_help():
 
 def main():
   try:
-    opts, args = getopt.getopt(sys.argv[1:], "r:umaf")
+    opts, args = getopt.getopt(sys.argv[1:], "r:umac:f")
   except getopt.GetoptError as err:
     print(err)
     print_help()
@@ -176,6 +280,9 @@ def main():
     elif key == "-a":
       repo_action = Action.ANALYZE_REPO
       report_folder = value
+    elif key == "-c":
+      repo_action = Action.PROCESS_REPO
+      report_folder = value
     elif key == "-f":
       FORCE = True
     else:
@@ -195,6 +302,8 @@ def main():
     modify_repo(repo_path)
   elif repo_action == Action.ANALYZE_REPO:
     analyze_repo(repo_path, report_folder)
+  elif repo_action == Action.PROCESS_REPO:
+    process_repo(repo_path, report_folder)
 
 if __name__ == "__main__":
   main()
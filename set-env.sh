@@ -5,3 +5,11 @@ export DST_GITLAB_URL="https://dst_gitlab.local"
 export DST_TOKEN="xxx"
 
 export GIT_BINARY="/opt/rh/rh-git227/root/usr/bin/git"
+
+# [optional] number of projects migrated in parallel, defaults to 16 (8 exports + 8 imports).
+# Project exports are kept on disk, and request concurrency adapts to each gitlab's rate limits.
+export MAX_WORKERS=16
+
+# [optional] cache of modified repos, 0 bytes disables it
+export CACHE_DIR="$HOME/.cache/modify-gitrepo"
+export CACHE_MAX_BYTES=10737418240